@@ -3,9 +3,33 @@
 # Date: 12/29/2020
 # Version 1.2
 
-import pygame, random, math, time
+import pygame, random, math, time, tracemalloc, gc, struct, asyncio, threading, sys
+from collections import deque
 from pygame.locals import *
 import os.path as path
+import numpy
+
+def sweep_circle(start, end, center, radius):
+    '''sweep_circle(start, end, center, radius) -> float
+    returns how far along the segment from start to end it first touches
+    the circle, from 0 to 1. returns None if it never does'''
+    dx, dy = end[0]-start[0], end[1]-start[1]
+    fx, fy = start[0]-center[0], start[1]-center[1]
+
+    # starts inside
+    c = fx**2+fy**2-radius**2
+    if c <= 0:
+        return 0
+
+    # moving away or not at all
+    a = dx**2+dy**2
+    b = fx*dx+fy*dy
+    if a == 0 or b >= 0 or b**2-a*c < 0:
+        return None
+
+    t = (-b-math.sqrt(b**2-a*c))/a
+    if t <= 1:
+        return t
 
 class MDMovable:
     '''movable object to inherit from'''
@@ -17,7 +41,10 @@ class MDMovable:
         self.image  = surface
         self.rect   = surface.get_rect()
         self.pos = 0,0
+        self.lastPos = self.pos
         self.heading = 0
+        self.angle = 0
+        self.flipped = False
 
     def get_heading(self):
         '''MDMovable.get_heading() -> int
@@ -31,10 +58,13 @@ class MDMovable:
         self.image.convert()
         self.rect = self.image.get_rect()
         self.heading = math.radians(heading)
+        self.angle = heading
+        self.flipped = False
 
     def forward(self, distance):
         '''MDMoveable.forward(distance) -> None
         moves the object forward by distance'''
+        self.lastPos = self.pos
         self.pos = self.pos[0]+distance*math.cos(self.heading), self.pos[1]-distance*math.sin(self.heading)
         self.rect.center = round(self.pos[0]), round(self.pos[1])
         
@@ -74,13 +104,28 @@ class MDPlayer:
         self.image = self.dead
         self.end = True
 
-    def collide(self, pos, rFactor=1.9):
-        '''MDPlayer.collide(pos) -> int
+    def sweep(self, start, end, rFactor=1.9):
+        '''MDPlayer.sweep(start, end, rFactor=1.9) -> (x,y)
+        returns where the path from start to end first touches the player
+        returns None if it does not touch the player'''
+        t = sweep_circle(start, end, self.rect.center, self.rect.width/rFactor)
+        if t != None:
+            return start[0]+(end[0]-start[0])*t, start[1]+(end[1]-start[1])*t
+
+    def collide(self, pos, rFactor=1.9, start=None):
+        '''MDPlayer.collide(pos, rFactor=1.9, start=None) -> int
         returns the heading a meteor should go after collide
-        returns None if meteor does not collide'''
-        if (self.rect.center[0]-pos[0])**2+(self.rect.center[1]-pos[1])**2 <= self.rect.width**2/(rFactor**2) \
-           and pos[1] < self.rect.center[1]:
-            return math.degrees(math.acos(-(self.rect.center[0]-pos[0])*rFactor/self.rect.width))
+        returns None if meteor does not collide
+        if start is given the whole path from start to pos is checked'''
+        if start != None:
+            pos = self.sweep(start, pos, rFactor)
+            if pos == None:
+                return
+        elif (self.rect.center[0]-pos[0])**2+(self.rect.center[1]-pos[1])**2 > self.rect.width**2/(rFactor**2):
+            return
+
+        if pos[1] < self.rect.center[1]:
+            return math.degrees(math.acos(max(-1, min(1, -(self.rect.center[0]-pos[0])*rFactor/self.rect.width))))
 
     def hover(self):
         '''MDPlayer.hover() -> None
@@ -139,6 +184,7 @@ class MDSpaceship(MDMovable):
         MDMovable.__init__(self, self.origin)
 
         self.pos = 600, -100
+        self.lastPos = self.pos
         self.speed = 4
         self.dir = 1
         self.end = False
@@ -177,23 +223,28 @@ class MDSpaceship(MDMovable):
 
         # move
         self.pos = (1199,1)[(self.dir+1)//2], 10
+        self.lastPos = self.pos
 
     def hide(self):
         '''MDSpaceship.hide() -> None
         hides the spaceship'''
         self.pos = 600, -200
+        self.lastPos = self.pos
 
     def add_debris(self, howMany):
         '''MDSpaceship.add_debris(howMany):
         adds howMany pieces of debris to the ship'''
+        self.game.get_profiler().begin("MDDebris creation")
         for i in range(howMany):
            MDDebris(self.game, (self.pos[0]+random.randint(-80,80), self.pos[1]+random.randint(-30,30)), self.debris)
+        self.game.get_profiler().end()
 
     def flip(self):
         '''MDSpaceship.flip() -> None
         flips the shaceship'''
         self.heading = math.radians(180-math.degrees(self.heading))
         self.image = pygame.transform.flip(self.image, True, False)
+        self.flipped = not self.flipped
         self.dir = -self.dir
 
     def update_ship(self):
@@ -231,19 +282,21 @@ class MDSpaceship(MDMovable):
         
     def collision(self):
         '''MDSpaceship.collision() -> list
-        returns all the meteors hitting shapeship'''        
+        returns all the meteors hitting shapeship
+        meteors are checked along their whole path since the last move'''        
         output = []
         width, height = 240, 40
         for meteor in self.game.get_meteors():
-            pos = meteor.get_rect().center
+            pos, lastPos = meteor.get_pos(), meteor.get_last_pos()
             
             # meteor is out of screen
             if not -10 < pos[0] < 1210 or pos[1] < -10:
                 continue
 
-            # check if meteor has hit
-            if 0 < meteor.get_heading() < 180 and \
-               ((self.pos[0]-pos[0])**2 + (self.pos[1]-pos[1])**2)**(1/2) < width/2:
+            # check if meteor has hit, relative to the moving ship
+            start = lastPos[0]-self.lastPos[0], lastPos[1]-self.lastPos[1]
+            end = pos[0]-self.pos[0], pos[1]-self.pos[1]
+            if 0 < meteor.get_heading() < 180 and sweep_circle(start, end, (0,0), width/2) != None:
                 output.append(meteor)
         return output
 
@@ -255,9 +308,11 @@ class MDDebris(MDMovable):
         constructs the debris object'''
         # set up surface
         self.surface = pygame.Surface((random.randint(2,4),random.randint(2,4)))
-        self.surface.fill((random.randint(0,50),random.randint(0,50),255))
+        self.color = random.randint(0,50), random.randint(0,50), 255
+        self.surface.fill(self.color)
         MDMovable.__init__(self, self.surface)
         self.pos = pos
+        self.lastPos = pos
         self.game = game
         self.debrisList = debrisList
         debrisList.append(self)
@@ -273,7 +328,7 @@ class MDDebris(MDMovable):
         updates the piece of debris'''
         # turn and move
         if -30 < self.pos[1] < self.end and -30 < self.pos[0] < 1230:
-            collide = self.game.get_player().collide(self.pos, 3)
+            collide = self.game.get_player().collide(self.pos, 3, self.lastPos)
             if collide and self.collide:
                 self.set_heading(collide)
             self.forward(self.speed)
@@ -310,6 +365,16 @@ class MDMeteor(MDMovable):
         returns the rectangle of the meteor'''
         return self.rect
 
+    def get_pos(self):
+        '''MDMeteor.get_pos() -> (x,y)
+        returns the position of the meteor'''
+        return self.pos
+
+    def get_last_pos(self):
+        '''MDMeteor.get_last_pos() -> (x,y)
+        returns the position of the meteor before its last move'''
+        return self.lastPos
+
     def get_head_pos(self):
         '''MDMeteor.get_head_pos() -> (x,y)
         returns the position of the meteor's head'''
@@ -330,28 +395,52 @@ class MDMeteor(MDMovable):
         drops the meteor from a random position'''
         if self.game.is_over():
             self.pos = (-200, -200)
+            self.lastPos = self.pos
             self.set_heading(90)
             return
         
         self.pos = random.randint(0,1200), -50
+        self.lastPos = self.pos
         self.set_heading(random.randint(250,290))
         
     def bounce(self):
         '''MDMeteor.bounce() -> None
         meteor does a bounce if needed'''
-        heading = self.game.get_player().collide(self.pos)
+        player = self.game.get_player()
+        heading = player.collide(self.pos, start=self.lastPos)
         
         if heading != None and not self.collided:
+            # bounce from where it touched the player
+            self.pos = player.sweep(self.lastPos, self.pos)
+            self.rect.center = round(self.pos[0]), round(self.pos[1])
             self.game.explosion(self.get_head_pos(), 80, 5)
             self.set_heading(heading)
         elif self.pos[1] < -50 or not 0 < self.pos[0] < 1200:
             self.random_drop()
-        elif self.pos[1] > 660:
+        elif self.pos[1] > self.game.get_craters().ground_level(self.pos[0]):
+            # make the crater where it hit the ground
+            self.pos = self.ground_hit()
+            self.rect.center = round(self.pos[0]), round(self.pos[1])
             self.game.crater(self.get_head_pos(), 120)
             self.random_drop()
                 
         self.collided = heading != None
         
+    def ground_hit(self):
+        '''MDMeteor.ground_hit() -> (x,y)
+        returns where the path of the meteor since its last move crosses the ground'''
+        craters = self.game.get_craters()
+        (startX, startY), (endX, endY) = self.lastPos, self.pos
+        if endY == startY:
+            return self.pos
+
+        # the ground is not flat, so close in on the crossing
+        t = 1
+        for i in range(3):
+            x = startX+(endX-startX)*t
+            t = min(1, max(0, (craters.ground_level(x)-startY)/(endY-startY)))
+        return startX+(endX-startX)*t, startY+(endY-startY)*t
+
     def update(self):
         '''MDMeteor.move() -> None
         moves the meteor forward by "forward"'''
@@ -368,16 +457,19 @@ class MDMeteor(MDMovable):
 class MDExplosion:
     '''represents an explosion in the game'''
 
-    def __init__(self, screen, pos, size, speed, expType=1, frames=3, expId=None):
-        '''MDExplosion(screen, pos, size, speed, expType=1, frames=3, expId=None) -> None
+    def __init__(self, game, pos, size, speed, expType=1, frames=3, expId=None):
+        '''MDExplosion(game, pos, size, speed, expType=1, frames=3, expId=None) -> None
         contructs an explosion at pos with size'''
-        self.screen = screen
+        self.game = game
         self.pos = pos[0]-size/2, pos[1]-size/2
         self.size = size
         self.count = 0
         self.speed = speed
         self.frames = frames
+        self.expType = expType
         self.expId = expId
+        self.image = None
+        self.index = -1
         self.imgs = [pygame.image.load(f"explosion{expType}_{i}.png") for i in range(1,frames+1)]
 
     def get_id(self):
@@ -393,93 +485,111 @@ class MDExplosion:
     def update(self):
         '''MDExplosion.update() -> None
         updates the explosion'''
-        img = pygame.transform.rotozoom(self.imgs[self.count//self.speed], 0, self.size/500)
-        self.screen.blit(img, self.pos)
+        # only scale a frame when it changes
+        step = self.game.get_governor().frame_step()
+        index = self.count//self.speed//step*step
+        if index != self.index:
+            self.game.get_profiler().begin("explosion rotozoom")
+            self.image = pygame.transform.rotozoom(self.imgs[index], 0, self.size/500)
+            self.game.get_profiler().end()
+            self.index = index
+        self.game.get_screen().blit(self.image, self.pos)
         self.count += 1
 
 class MDCraters:
-    '''represents all of the craters in one'''
+    '''represents all of the craters in one
+    the ground is kept as how deep each column of pixels is'''
 
-    def __init__(self, game):
-        '''MDCraters(game) -> MDCrater
-        constructs the craters for the game'''
+    def __init__(self, game, ground=660, layerTop=500):
+        '''MDCraters(game, ground=660, layerTop=500) -> MDCrater
+        constructs the craters for the game
+        craters are drawn on a layer from layerTop to the bottom of the screen'''
         self.craters = []
-        self.intervals = []
+        self.debris = []
         self.game = game
+        self.ground = ground
+
+        # heightmap, and the run of crater columns each column is in
+        self.depth = numpy.zeros(1200)
+        self.left = numpy.zeros(1200, dtype=int)
+        self.right = numpy.zeros(1200, dtype=int)
+
+        self.layerTop = layerTop
+        self.layer = pygame.Surface((1200, 700-layerTop))
+        self.layer.set_colorkey((0,0,0))
 
     def stopped(self, pos):
         '''MDCraters.stopped(pos) -> bool
         returns if pos is not valid move with craters
         pos is (start,end,width)'''
-        for interval in self.intervals:
-            if abs(interval[0]-interval[1]) > pos[2] and ((pos[1] > pos[0] and pos[0] <= interval[0] <= pos[1]) \
-                or (pos[1] < pos[0] and pos[1] <= interval[1] <= pos[0]) or interval[0] < pos[0] < interval[1]):
-                return (True, interval)
+        start, end = sorted((min(max(int(pos[0]), 0), 1199), min(max(int(pos[1]), 0), 1199)))
+        wide = self.right[start:end+1]-self.left[start:end+1] > pos[2]
+        if wide.any():
+            column = start+wide.argmax()
+            return (True, [int(self.left[column]), int(self.right[column])])
         return (False, None)
 
+    def get_depth(self, x):
+        '''MDCraters.get_depth(x) -> float
+        returns how deep the craters are at x'''
+        return self.depth[min(max(int(x), 0), 1199)]
+
+    def ground_level(self, x):
+        '''MDCraters.ground_level(x) -> float
+        returns the height of the ground at x'''
+        return self.ground+self.get_depth(x)
+
     def add_debris(self, debris):
         '''MDCraters.add_debris(debris) -> None
         adds a bit of debris to the craters'''
-        self.craters.append(debris)
+        self.debris.append(debris)
 
     def add_crater(self, crater):
         '''MDCraters.add_crater(crater) -> None
         adds a crater to the screen
         crater is (x,y,width,height)'''
         self.craters.append(crater)
-        self.add_interval(crater)
+        self.add_depth(crater)
+        pygame.draw.ellipse(self.layer, (127,127,127), (crater[0], crater[1]-self.layerTop, crater[2], crater[3]))
 
-    def add_interval(self, crater):
-        '''MDCraters.add_interval(crater) -> None
-        adds an interval that tells where craters are
+    def add_depth(self, crater):
+        '''MDCraters.add_depth(crater) -> None
+        digs the crater into the heightmap
         crater is (x,y,width,height)'''
-        newInts = []
-        intervals = self.intervals[:]
-        for i in range(len(intervals)):
-            left, right = intervals[i][0] <= crater[0] <= intervals[i][1], \
-                intervals[i][0] <= crater[0]+crater[2] <= intervals[i][1]
-
-            if left and right:
-                return
-            if left:
-                newInts.append([intervals[i][0], crater[0]+crater[2]])
-                self.intervals.remove(intervals[i])
-            elif right:
-                newInts.append([crater[0], intervals[i][1]])
-                self.intervals.remove(intervals[i])
-
-        # not touching other craters
-        if len(newInts) == 1:
-            self.intervals.append(newInts[0])
-            return
-        if len(newInts) == 0:
-            self.intervals.append([crater[0], crater[0]+crater[2]])
+        start, end = max(int(crater[0]), 0), min(math.ceil(crater[0]+crater[2]), 1200)
+        if start >= end:
             return
 
-        # remove ints from list and combine
-        mn, mx = newInts[0][0], newInts[0][1]
-        for interval in newInts:
-            if min(interval) < mn:
-                mn = min(interval)
-            if max(interval) > mx:
-                mx = max(interval)
+        # half an ellipse deep
+        columns = (numpy.arange(start, end)+0.5-crater[0]-crater[2]/2)/(crater[2]/2)
+        depth = crater[3]/2*numpy.sqrt(numpy.clip(1-columns**2, 0, 1))
+        numpy.maximum(self.depth[start:end], depth, out=self.depth[start:end])
 
-        self.intervals.append([mn, mx])
+        # find the runs of crater columns
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], self.depth > 0, [0])).astype(int)))
+        self.left[:] = 0
+        self.right[:] = 0
+        for left, right in zip(edges[::2], edges[1::2]):
+            self.left[left:right] = left
+            self.right[left:right] = right
 
     def clear(self):
         '''MDCraters.clear() -> None
         clears all craters'''
         self.craters.clear()
-        self.intervals.clear()
+        self.debris.clear()
+        self.depth[:] = 0
+        self.left[:] = 0
+        self.right[:] = 0
+        self.layer.fill((0,0,0))
         
     def update(self):
         '''MDCraters.update() -> None
         updates all craters'''
-        for crater in self.craters:
-            if isinstance(crater, MDDebris):
-                crater.update()
-            else:
-                pygame.draw.ellipse(self.game.get_screen(), (127,127,127), crater)
+        if self.craters:
+            self.game.get_screen().blit(self.layer, (0, self.layerTop))
+        for debris in self.debris:
+            debris.update()
 
 class MDEnergy:
     '''represents the energy indicator'''
@@ -532,21 +642,1034 @@ class MDEnergy:
         pygame.draw.rect(self.game.get_screen(), (0, 255, 0), self.rect)
         self.game.get_screen().blit(self.image, (1130, 15))
         
+class MDProfiler:
+    '''records allocations and gc pauses per frame and per subsystem'''
+
+    def __init__(self, game, enabled=False, fileName="moondefense_profile.txt", every=300):
+        '''MDProfiler(game, enabled=False, fileName="moondefense_profile.txt", every=300) -> MDProfiler
+        constructs the profiler. Does nothing unless enabled
+        line growth is sampled every "every" frames'''
+        self.game = game
+        self.enabled = enabled
+        self.fileName = fileName
+        self.every = every
+
+        self.frames = 0
+        self.stack = []
+        self.sections = {}
+        self.frameStart = 0
+        self.frameBytes = 0
+        self.frameGc = 0
+        self.worstFrame = 0
+        self.totalTime = 0
+        self.last = (0, 0, 0)
+
+        self.gcStart = 0
+        self.gcCount = 0
+        self.gcTime = 0
+        self.gcWorst = 0
+        self.hotSpots = []
+        self.snapshot = None
+        self.hooks = []
+
+        if enabled:
+            tracemalloc.start()
+            gc.callbacks.append(self.gc_callback)
+            self.hook(MDMovable, "set_heading", "set_heading rotozoom")
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def hook(self, cls, name, section):
+        '''MDProfiler.hook(cls, name, section) -> None
+        measures every call of the method cls.name as section
+        the method is put back by report'''
+        method = getattr(cls, name)
+        def measured(*args, **kwargs):
+            self.begin(section)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.end()
+        self.hooks.append((cls, name, method))
+        setattr(cls, name, measured)
+
+    def gc_callback(self, phase, info):
+        '''MDProfiler.gc_callback(phase, info) -> None
+        times garbage collection pauses'''
+        if phase == "start":
+            self.gcStart = time.perf_counter()
+            return
+
+        pause = time.perf_counter()-self.gcStart
+        self.gcCount += 1
+        self.gcTime += pause
+        self.frameGc += pause
+        if pause > self.gcWorst:
+            self.gcWorst = pause
+
+    def begin(self, name):
+        '''MDProfiler.begin(name) -> None
+        starts measuring the subsystem name
+        sections may be nested'''
+        if not self.enabled:
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1][3] = max(self.stack[-1][3], peak)
+        self.stack.append([name, time.perf_counter(), current, current])
+        tracemalloc.reset_peak()
+
+    def end(self):
+        '''MDProfiler.end() -> None
+        stops measuring the last subsystem started'''
+        if not self.enabled:
+            return
+
+        name, start, startMemory, peak = self.stack.pop()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if self.stack:
+            self.stack[-1][3] = max(self.stack[-1][3], peak)
+        else:
+            self.frameBytes += peak-startMemory
+
+        # calls, bytes, seconds
+        section = self.sections.setdefault(name, [0, 0, 0])
+        section[0] += 1
+        section[1] += peak-startMemory
+        section[2] += time.perf_counter()-start
+
+    def start_frame(self):
+        '''MDProfiler.start_frame() -> None
+        starts a new frame'''
+        if not self.enabled:
+            return
+        self.frameStart = time.perf_counter()
+        self.frameBytes = 0
+        self.frameGc = 0
+
+    def end_frame(self):
+        '''MDProfiler.end_frame() -> None
+        finishes the frame and samples line growth if needed'''
+        if not self.enabled:
+            return
+
+        frameTime = time.perf_counter()-self.frameStart
+        self.frames += 1
+        self.totalTime += frameTime
+        if frameTime > self.worstFrame:
+            self.worstFrame = frameTime
+        self.last = (frameTime*1000, self.frameBytes/1024, self.frameGc*1000)
+
+        # lines that keep growing between samples
+        if self.frames%self.every == 0:
+            snapshot = tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self.snapshot, "lineno")
+            self.hotSpots.append((self.frames, [stat for stat in stats[:5] if stat.size_diff > 0]))
+            self.snapshot = snapshot
+
+    def draw(self, screen):
+        '''MDProfiler.draw(screen) -> None
+        draws the stats of the last frame on screen'''
+        if not self.enabled:
+            return
+        text = "%.1f ms  %.1f KB  gc %.1f ms" % self.last
+        screen.blit(self.game.notif.render(text, True, (255,255,0)), (10, 675))
+
+    def report(self):
+        '''MDProfiler.report() -> None
+        writes the report to the file and stops tracing'''
+        if not self.enabled:
+            return
+        gc.callbacks.remove(self.gc_callback)
+        for cls, name, method in self.hooks:
+            setattr(cls, name, method)
+        tracemalloc.stop()
+        self.enabled = False
+        frames = max(self.frames, 1)
+
+        file = open(self.fileName, "w")
+        file.write(f"frames: {self.frames}\n")
+        file.write(f"frame time: avg {self.totalTime*1000/frames:.2f} ms, worst {self.worstFrame*1000:.2f} ms\n")
+        file.write(f"gc: {self.gcCount} collections, {self.gcTime*1000:.2f} ms total, worst pause {self.gcWorst*1000:.2f} ms\n\n")
+
+        # subsystems, most allocations first
+        file.write(f"{'subsystem':<24}{'calls':>10}{'KB/frame':>12}{'ms/frame':>12}\n")
+        for name, (calls, size, seconds) in sorted(self.sections.items(), key=lambda item: -item[1][1]):
+            flag = "  HOT" if size/frames > 1024 else ""
+            file.write(f"{name:<24}{calls:>10}{size/1024/frames:>12.2f}{seconds*1000/frames:>12.3f}{flag}\n")
+
+        # lines that kept memory between samples
+        file.write("\ngrowth by line:\n")
+        for frame, stats in self.hotSpots:
+            for stat in stats:
+                file.write(f"frame {frame}: {stat}\n")
+        file.close()
+
+class MDRewind:
+    '''captures and restores the game state as packed binary snapshots
+    keeps a ring buffer of recent snapshots for rewinding'''
+
+    # iterations, enemyDrop, score, endWait, explosionCount, gameOver, cleared, started
+    # energy howFull, height, emptying, seconds since emptied, enemyWait
+    GAME = struct.Struct("<IiIiI???dh?dH")
+    # center, hoverCount, hoverHeight, hovering, end, explosion id
+    PLAYER = struct.Struct("<hhhh??I")
+    # pos, lastPos, heading, angle, speed, dir, end, dontUpdate, flipped, numHits
+    SHIP = struct.Struct("<ddddddhb???H")
+    # pos, lastPos, angle, speed, collided, end
+    METEOR = struct.Struct("<dddddh??")
+    # pos, lastPos, angle, speed, end, collide, width, height, red, green
+    DEBRIS = struct.Struct("<ddddddh?BBBB")
+    # x, y, width, height
+    CRATER = struct.Struct("<dddd")
+    # pos, size, speed, expType, frames, count, id
+    EXPLOSION = struct.Struct("<dddhBBHI")
+    COUNT = struct.Struct("<I")
+    ID = struct.Struct("<I")
+    # version, state, has gauss, gauss
+    RANDOM = struct.Struct("<I625I?d")
+
+    def __init__(self, game, every=30, size=120):
+        '''MDRewind(game, every=30, size=120) -> MDRewind
+        constructs the rewinder. A snapshot is kept every "every" ticks
+        and at most size snapshots are kept'''
+        self.game = game
+        self.every = every
+        self.snapshots = deque(maxlen=size)
+
+    def exp_number(self, expId):
+        '''MDRewind.exp_number(expId) -> int
+        returns the number of the explosion id, 0 for None'''
+        if expId == None:
+            return 0
+        return int(expId[3:])
+
+    def exp_id(self, number):
+        '''MDRewind.exp_id(number) -> str
+        returns the explosion id of the number, None for 0'''
+        if number == 0:
+            return None
+        return f"exp{number}"
+
+    def pack_list(self, packer, items):
+        '''MDRewind.pack_list(packer, items) -> bytes
+        packs a list of tuples with a count in front'''
+        return self.COUNT.pack(len(items)) + b"".join(packer.pack(*item) for item in items)
+
+    def unpack_list(self, packer, data, offset):
+        '''MDRewind.unpack_list(packer, data, offset) -> (list, offset)
+        unpacks a list of tuples packed with pack_list'''
+        count = self.COUNT.unpack_from(data, offset)[0]
+        offset += self.COUNT.size
+        items = [packer.unpack_from(data, offset+i*packer.size) for i in range(count)]
+        return items, offset+count*packer.size
+
+    def capture(self):
+        '''MDRewind.capture() -> bytes
+        returns a snapshot of the game state'''
+        game = self.game
+        player, ship, energy = game.player, game.enemy, game.energy
+        data = [
+            self.GAME.pack(game.iterations, game.enemyDrop, game.score, game.endWait, game.explosionCount,
+                game.gameOver, game.cleared, game.started, energy.howFull, energy.rect.height,
+                energy.emptying, time.time()-energy.emptyTime, game.enemyWait),
+            self.PLAYER.pack(player.rect.center[0], player.rect.center[1], player.hoverCount, player.hoverHeight,
+                player.hovering, player.end, self.exp_number(player.expId)),
+            self.SHIP.pack(*ship.pos, *ship.lastPos, ship.heading, ship.angle, ship.speed, ship.dir,
+                ship.end, ship.dontUpdate, ship.flipped, ship.numHits),
+            self.pack_list(self.METEOR, [(*meteor.pos, *meteor.lastPos, meteor.angle, meteor.speed,
+                meteor.collided, meteor.end) for meteor in game.meteors]),
+            self.pack_list(self.DEBRIS, [(*debris.pos, *debris.lastPos, debris.angle, debris.speed, debris.end,
+                debris.collide, *debris.surface.get_size(), *debris.color[:2]) for debris in ship.debris]),
+            self.pack_list(self.CRATER, game.craters.craters),
+            self.pack_list(self.EXPLOSION, [(*explosion.pos, explosion.size, explosion.speed, explosion.expType,
+                explosion.frames, explosion.count, self.exp_number(explosion.get_id())) for explosion in game.explosions]),
+            self.pack_list(self.ID, [(self.exp_number(expId),) for expId in game.finishedExplosions])
+        ]
+
+        # random state
+        version, state, gauss = random.getstate()
+        data.append(self.RANDOM.pack(version, *state, gauss != None, gauss or 0))
+        return b"".join(data)
+
+    def restore(self, data):
+        '''MDRewind.restore(data) -> None
+        restores the game to the snapshot data'''
+        game = self.game
+        player, ship, energy = game.player, game.enemy, game.energy
+
+        # game and energy
+        (game.iterations, game.enemyDrop, game.score, game.endWait, game.explosionCount, game.gameOver,
+            game.cleared, game.started, energy.howFull, energy.rect.height, energy.emptying,
+            emptied, game.enemyWait) = self.GAME.unpack_from(data)
+        energy.emptyTime = time.time()-emptied
+        offset = self.GAME.size
+
+        # player
+        x, y, player.hoverCount, player.hoverHeight, player.hovering, player.end, expId = self.PLAYER.unpack_from(data, offset)
+        offset += self.PLAYER.size
+        player.rect.center = x, y
+        player.expId = self.exp_id(expId)
+        player.image = player.dead if player.end else (player.origin, player.fire)[player.hovering]
+
+        # ship
+        x, y, lastX, lastY, heading, angle, ship.speed, ship.dir, ship.end, ship.dontUpdate, flipped, \
+            ship.numHits = self.SHIP.unpack_from(data, offset)
+        offset += self.SHIP.size
+        ship.set_heading(angle)
+        if flipped:
+            ship.image = pygame.transform.flip(ship.image, True, False)
+            ship.flipped = True
+        ship.heading, ship.pos, ship.lastPos = heading, (x, y), (lastX, lastY)
+        ship.rect.center = round(x), round(y)
+
+        # meteors, reusing the ones already made
+        meteors, offset = self.unpack_list(self.METEOR, data, offset)
+        while len(game.meteors) < len(meteors):
+            game.meteors.append(MDMeteor(game))
+        del game.meteors[len(meteors):]
+        for meteor, (x, y, lastX, lastY, angle, meteor.speed, meteor.collided, meteor.end) in zip(game.meteors, meteors):
+            meteor.set_heading(angle)
+            meteor.pos, meteor.lastPos = (x, y), (lastX, lastY)
+            meteor.rect.center = round(x), round(y)
+
+        # debris
+        debrisList, offset = self.unpack_list(self.DEBRIS, data, offset)
+        ship.debris.clear()
+        for x, y, lastX, lastY, angle, speed, end, collide, width, height, red, green in debrisList:
+            debris = MDDebris(game, (x, y), ship.debris)
+            debris.color = red, green, 255
+            debris.surface = debris.origin = pygame.Surface((width, height))
+            debris.surface.fill(debris.color)
+            debris.set_heading(angle)
+            debris.lastPos, debris.speed, debris.end, debris.collide = (lastX, lastY), speed, end, collide
+            debris.rect.center = round(x), round(y)
+
+        # craters, digging the heightmap again
+        craters, offset = self.unpack_list(self.CRATER, data, offset)
+        game.craters.clear()
+        for crater in craters:
+            game.craters.add_crater(crater)
+
+        # explosions
+        explosions, offset = self.unpack_list(self.EXPLOSION, data, offset)
+        game.explosions.clear()
+        for x, y, size, speed, expType, frames, count, expId in explosions:
+            explosion = MDExplosion(game, (0, 0), size, speed, expType, frames, self.exp_id(expId))
+            explosion.pos, explosion.count = (x, y), count
+            game.explosions.append(explosion)
+        finished, offset = self.unpack_list(self.ID, data, offset)
+        game.finishedExplosions[:] = [self.exp_id(expId) for expId, in finished]
+
+        # random state last, making objects above uses it
+        state = self.RANDOM.unpack_from(data, offset)
+        random.setstate((state[0], state[1:626], state[627] if state[626] else None))
+
+    def record(self):
+        '''MDRewind.record() -> None
+        keeps a snapshot if it is time to'''
+        if self.game.iterations%self.every == 0:
+            self.snapshots.append(self.capture())
+
+    def rewind(self, steps=1):
+        '''MDRewind.rewind(steps=1) -> bool
+        restores the game to steps snapshots ago and forgets the newer ones
+        returns False if there are not enough snapshots'''
+        if len(self.snapshots) < steps:
+            return False
+        for i in range(steps-1):
+            self.snapshots.pop()
+        self.restore(self.snapshots[-1])
+        return True
+
+class MDServer:
+    '''streams the game state to clients over TCP and collects their inputs
+    runs asyncio on its own thread'''
+
+    KEY, DELTA, MOVE, PRESS, PING, PONG = range(6)
+    # how each section of a state is sent
+    SAME, MASK, FULL = range(3)
+    SECTIONS = 5
+    QUANT = 4
+
+    def __init__(self, game, host="0.0.0.0", port=5750, maxBuffer=65536):
+        '''MDServer(game, host="0.0.0.0", port=5750, maxBuffer=65536) -> MDServer
+        constructs the server and starts listening. Port 0 picks a free port
+        clients with more than maxBuffer bytes waiting are skipped until they catch up'''
+        self.game = game
+        self.host = host
+        self.port = port
+        self.maxBuffer = maxBuffer
+        self.clients = {}
+        self.tasks = set()
+        self.inputs = deque()
+        self.last = None
+        self.tick = 0
+
+        # counters
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.keyframes = 0
+        self.deltas = 0
+        self.rateTime = time.time()
+        self.rateBytes = 0
+        self.sendRate = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error != None:
+            self.thread.join()
+            self.loop.close()
+            raise self.error
+
+    def run(self):
+        '''MDServer.run() -> None
+        runs the event loop of the server'''
+        asyncio.set_event_loop(self.loop)
+        self.error = None
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+        except OSError as error:
+            self.error = error
+            return
+        finally:
+            self.ready.set()
+        self.loop.run_forever()
+
+    def close(self):
+        '''MDServer.close() -> None
+        stops the server'''
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def shutdown(self):
+        '''MDServer.shutdown() -> None
+        disconnects all clients and stops listening'''
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+
+        # closed clients stop reading on their own, cancel any that don't
+        if self.tasks:
+            done, pending = await asyncio.wait(list(self.tasks), timeout=1)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        '''MDServer.handle(reader, writer) -> None
+        reads the messages of one client'''
+        self.clients[writer] = True
+        self.tasks.add(asyncio.current_task())
+        try:
+            while True:
+                size = struct.unpack("<H", await reader.readexactly(2))[0]
+                data = await reader.readexactly(size)
+                self.bytesReceived += size+2
+                if not data:
+                    continue
+                if data[0] == self.PING:
+                    self.send(writer, bytes([self.PONG])+data[1:])
+                else:
+                    self.inputs.append(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.clients[writer]
+            self.tasks.discard(asyncio.current_task())
+            writer.close()
+
+    def send(self, writer, payload):
+        '''MDServer.send(writer, payload) -> None
+        sends payload to a client with its length in front'''
+        self.bytesSent += len(payload)+2
+        writer.write(struct.pack("<H", len(payload))+payload)
+
+    def take_inputs(self):
+        '''MDServer.take_inputs() -> list
+        returns the inputs of the clients since the last call
+        each input is ("move", x) or ("press", None)'''
+        inputs = []
+        while self.inputs:
+            data = self.inputs.popleft()
+            if data[0] == self.MOVE and len(data) == 3:
+                inputs.append(("move", struct.unpack_from("<h", data, 1)[0]))
+            elif data[0] == self.PRESS:
+                inputs.append(("press", None))
+        return inputs
+
+    def state(self):
+        '''MDServer.state() -> list
+        returns the game state as lists of quantized int16 values
+        the sections are the header, meteors, craters, explosions and debris
+        each list but the header starts with how many objects it has'''
+        game = self.game
+        player, ship, q = game.get_player(), game.enemy, self.QUANT
+        header = [self.tick, game.score, game.gameOver, game.started, game.energy.rect.height,
+            *player.get_pos(), 2 if player.end else player.hovering,
+            ship.pos[0]*q, ship.pos[1]*q, ship.angle, ship.flipped]
+
+        meteors = [len(game.meteors)]
+        for meteor in game.meteors:
+            meteors += meteor.pos[0]*q, meteor.pos[1]*q, meteor.angle
+
+        craters = [len(game.get_craters().craters)]
+        for crater in game.get_craters().craters:
+            craters += crater
+
+        explosions = [len(game.explosions)]
+        for explosion in game.explosions:
+            explosions += *explosion.pos, explosion.size, explosion.expType, explosion.frames, \
+                min(explosion.count//explosion.speed, explosion.frames-1)
+
+        debris = [len(ship.debris)]
+        for piece in ship.debris:
+            debris += piece.pos[0]*q, piece.pos[1]*q
+        return [[max(-32768, min(32767, round(value))) for value in section]
+            for section in (header, meteors, craters, explosions, debris)]
+
+    def encode(self, sections, last=None):
+        '''MDServer.encode(sections, last=None) -> bytes
+        returns sections as the changes since last, or all of it if last is None
+        each section is sent the smallest way: unchanged, the changed values
+        after a bitmask of which changed, or in full'''
+        data = [bytes([(self.DELTA, self.KEY)[last == None]])]
+        for i, section in enumerate(sections):
+            full = struct.pack(f"<BH{len(section)}h", self.FULL, len(section), *section)
+            if last == None or len(last[i]) != len(section):
+                data.append(full)
+                continue
+
+            changed = [j for j, value in enumerate(section) if value != last[i][j]]
+            if not changed:
+                data.append(bytes([self.SAME]))
+                continue
+            mask = bytearray((len(section)+7)//8)
+            for j in changed:
+                mask[j//8] |= 1 << j%8
+            delta = bytes([self.MASK])+mask+struct.pack(f"<{len(changed)}h", *[section[j] for j in changed])
+            data.append(min(full, delta, key=len))
+        return b"".join(data)
+
+    def publish(self):
+        '''MDServer.publish() -> None
+        sends the state of this tick to all clients'''
+        self.tick = (self.tick+1)%32768
+        values = self.state()
+        self.loop.call_soon_threadsafe(self.broadcast, values)
+
+        # bandwidth
+        if time.time()-self.rateTime > 1:
+            self.sendRate = (self.bytesSent-self.rateBytes)/(time.time()-self.rateTime)
+            self.rateTime, self.rateBytes = time.time(), self.bytesSent
+
+    def broadcast(self, values):
+        '''MDServer.broadcast(values) -> None
+        sends values as a keyframe or as the changes since the last tick'''
+        key = self.encode(values)
+        delta = None if self.last == None else self.encode(values, self.last)
+        self.last = values
+
+        for writer, needsKey in list(self.clients.items()):
+            # skip clients that can't keep up, they get a keyframe later
+            if writer.transport.get_write_buffer_size() > self.maxBuffer:
+                self.clients[writer] = True
+            elif needsKey or delta == None:
+                self.keyframes += 1
+                self.clients[writer] = False
+                self.send(writer, key)
+            else:
+                self.deltas += 1
+                self.send(writer, delta)
+
+    def stats(self):
+        '''MDServer.stats() -> str
+        returns the network counters as text'''
+        return f"port {self.port}  clients {len(self.clients)}  sent {self.sendRate/1024:.1f} KB/s"
+
+class MDClient:
+    '''connects to a hosting game, keeps the last states it sent
+    and sends inputs back'''
+
+    def __init__(self, host, port=5750, pingEvery=1):
+        '''MDClient(host, port=5750, pingEvery=1) -> MDClient
+        constructs the client and connects to the host'''
+        self.host = host
+        self.port = port
+        self.pingEvery = pingEvery
+        self.connected = True
+        self.values = None
+        self.sections = None
+        self.states = None
+
+        # counters
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.latency = 0
+        self.tickTime = 1/60
+        self.rateTime = time.time()
+        self.rateBytes = 0
+        self.receiveRate = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error != None:
+            raise self.error
+
+    def run(self):
+        '''MDClient.run() -> None
+        runs the event loop of the client'''
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.reader, self.writer = self.loop.run_until_complete(asyncio.open_connection(self.host, self.port))
+            self.error = None
+        except OSError as error:
+            self.error = error
+            self.ready.set()
+            return
+
+        self.ready.set()
+        pinger = self.loop.create_task(self.ping())
+        self.loop.run_until_complete(self.receive())
+        self.connected = False
+        pinger.cancel()
+        self.loop.run_until_complete(asyncio.gather(pinger, return_exceptions=True))
+
+    def close(self):
+        '''MDClient.close() -> None
+        disconnects from the host'''
+        if self.connected:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        self.thread.join(1)
+
+    async def ping(self):
+        '''MDClient.ping() -> None
+        measures the round trip time to the host every pingEvery seconds'''
+        while self.connected:
+            self.write(bytes([MDServer.PING])+struct.pack("<d", time.perf_counter()))
+            await asyncio.sleep(self.pingEvery)
+
+    async def receive(self):
+        '''MDClient.receive() -> None
+        reads states from the host until it disconnects'''
+        try:
+            while True:
+                size = struct.unpack("<H", await self.reader.readexactly(2))[0]
+                data = await self.reader.readexactly(size)
+                self.bytesReceived += size+2
+                self.read(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def read(self, data):
+        '''MDClient.read(data) -> None
+        applies a message from the host'''
+        if not data:
+            return
+        if data[0] == MDServer.PONG:
+            if len(data) == 9:
+                self.latency = time.perf_counter()-struct.unpack_from("<d", data, 1)[0]
+            return
+        if data[0] == MDServer.KEY:
+            last = None
+        elif data[0] == MDServer.DELTA and self.sections != None:
+            last = self.sections
+        else:
+            return
+        sections = self.decode(data, last)
+        if sections == None:
+            return
+        self.sections = sections
+        values = [value for section in sections for value in section]
+
+        # keep the last two states for interpolation
+        now = time.perf_counter()
+        if self.states != None:
+            self.tickTime += (now-self.states[1][1]-self.tickTime)/10
+            self.states = self.states[1], (values, now)
+        else:
+            self.states = (values, now), (values, now)
+        self.values = values
+
+        # bandwidth
+        if time.time()-self.rateTime > 1:
+            self.receiveRate = (self.bytesReceived-self.rateBytes)/(time.time()-self.rateTime)
+            self.rateTime, self.rateBytes = time.time(), self.bytesReceived
+
+    def decode(self, data, last):
+        '''MDClient.decode(data, last) -> list
+        returns the sections sent by MDServer.encode, applied over last
+        returns None if the message does not fit last'''
+        sections = []
+        offset = 1
+        for i in range(MDServer.SECTIONS):
+            mode = data[offset]
+            offset += 1
+            if mode == MDServer.FULL:
+                count = struct.unpack_from("<H", data, offset)[0]
+                sections.append(list(struct.unpack_from(f"<{count}h", data, offset+2)))
+                offset += 2+count*2
+            elif last == None:
+                return
+            elif mode == MDServer.SAME:
+                sections.append(last[i])
+            else:
+                section = last[i][:]
+                mask = data[offset:offset+(len(section)+7)//8]
+                offset += len(mask)
+                changed = [j for j in range(len(section)) if mask[j//8] >> j%8 & 1]
+                for j, value in zip(changed, struct.unpack_from(f"<{len(changed)}h", data, offset)):
+                    section[j] = value
+                offset += len(changed)*2
+                sections.append(section)
+        return sections
+
+    def write(self, payload):
+        '''MDClient.write(payload) -> None
+        sends payload to the host, must be called on the client thread'''
+        if self.writer.is_closing():
+            return
+        self.writer.write(struct.pack("<H", len(payload))+payload)
+        self.bytesSent += len(payload)+2
+
+    def send(self, payload):
+        '''MDClient.send(payload) -> None
+        sends payload to the host from any thread'''
+        self.loop.call_soon_threadsafe(self.write, payload)
+
+    def move(self, x):
+        '''MDClient.move(x) -> None
+        moves the player on the host'''
+        self.send(bytes([MDServer.MOVE])+struct.pack("<h", round(x)))
+
+    def press(self):
+        '''MDClient.press() -> None
+        hovers or starts the game on the host'''
+        self.send(bytes([MDServer.PRESS]))
+
+    def get_states(self):
+        '''MDClient.get_states() -> ((values, time), (values, time))
+        returns the last two states and when they came, None if none came yet'''
+        return self.states
+
+    def stats(self):
+        '''MDClient.stats() -> str
+        returns the network counters as text'''
+        return f"received {self.receiveRate/1024:.1f} KB/s  ping {self.latency*1000:.1f} ms"
+
+class MDSpectator:
+    '''shows a game hosted somewhere else
+    its mouse and space bar also control the host's player'''
+
+    def __init__(self, address):
+        '''MDSpectator(address) -> MDSpectator
+        constructs the spectator and connects to address, "host" or "host:port"'''
+        host, port = (address.split(":")+["5750"])[:2]
+        self.client = MDClient(host, int(port))
+
+        pygame.display.set_caption("Moon Defense")
+        pygame.display.set_icon(pygame.image.load("logo.png"))
+        pygame.mouse.set_visible(False)
+        self.display = pygame.display.set_mode((0,0))
+        self.screen = pygame.Surface((1200,700))
+        self.width, self.height = pygame.display.get_window_size()
+        pygame.draw.rect(self.display, (255,255,255), (self.width/2-600,self.height/2-350,1200,700), 5)
+
+        # images
+        self.background = pygame.image.load("landscape4.png")
+        self.title = pygame.image.load("title.png")
+        self.end = pygame.image.load("end.png")
+        self.meteor = pygame.transform.rotozoom(pygame.image.load("meteor7_1.png"), 0, 0.3)
+        self.ship = pygame.transform.rotozoom(pygame.image.load("spaceship.png"), 0, 0.4)
+        self.players = [pygame.transform.rotozoom(pygame.image.load(f"player6{name}.png"), 0, 0.2) for name in ("", "_fire", "_dead")]
+        self.energy = pygame.transform.rotozoom(pygame.image.load("energy.png"), 0, 0.5)
+        self.rotated = {}
+        self.explosions = {}
+
+        self.font = pygame.font.SysFont(None, 50)
+        self.notif = pygame.font.SysFont(None, 30)
+        self.mainloop()
+
+    def rotate(self, image, angle, flipped=False):
+        '''MDSpectator.rotate(image, angle, flipped=False) -> pygame.Surface
+        returns image rotated by angle, remembering the ones made'''
+        key = id(image), angle, flipped
+        if key not in self.rotated:
+            self.rotated[key] = pygame.transform.flip(pygame.transform.rotozoom(image, angle, 1), flipped, False)
+        return self.rotated[key]
+
+    def explosion(self, expType, frame, size):
+        '''MDSpectator.explosion(expType, frame, size) -> pygame.Surface
+        returns a frame of an explosion, remembering the ones made'''
+        key = expType, frame, size
+        if key not in self.explosions:
+            image = pygame.image.load(f"explosion{expType}_{frame+1}.png")
+            self.explosions[key] = pygame.transform.rotozoom(image, 0, size/500)
+        return self.explosions[key]
+
+    def decode(self, values):
+        '''MDSpectator.decode(values) -> dict
+        returns the state values sent by the host as a dict'''
+        q = MDServer.QUANT
+        state = dict(zip(("tick", "score", "over", "started", "energy", "playerX", "playerY", "player",
+            "shipX", "shipY", "shipAngle", "flipped"), values))
+        state["shipX"], state["shipY"] = state["shipX"]/q, state["shipY"]/q
+        i = 12
+
+        # lists of objects
+        for name, size in (("meteors", 3), ("craters", 4), ("explosions", 6), ("debris", 2)):
+            count = values[i]
+            state[name] = [values[i+1+j*size:i+1+(j+1)*size] for j in range(count)]
+            i += 1+count*size
+        state["meteors"] = [(x/q, y/q, angle) for x, y, angle in state["meteors"]]
+        state["debris"] = [(x/q, y/q) for x, y in state["debris"]]
+        return state
+
+    def interpolate(self, old, new, alpha):
+        '''MDSpectator.interpolate(old, new, alpha) -> dict
+        returns the state with positions between old and new
+        alpha is from 0 (old) to 1 (new)'''
+        lerp = lambda a, b: a+(b-a)*alpha
+        state = dict(new)
+        state["shipX"], state["shipY"] = lerp(old["shipX"], new["shipX"]), lerp(old["shipY"], new["shipY"])
+        for name in ("meteors", "debris"):
+            if len(old[name]) == len(new[name]):
+                state[name] = [(lerp(a[0], b[0]), lerp(a[1], b[1]), *b[2:]) for a, b in zip(old[name], new[name])]
+        return state
+
+    def draw(self, state):
+        '''MDSpectator.draw(state) -> None
+        draws the state on the screen'''
+        if not state["started"]:
+            self.screen.blit(self.background, (0,0))
+            self.screen.blit((self.title, self.end)[state["over"]], (0,0))
+        else:
+            self.screen.blit(self.background, (0,0))
+            for crater in state["craters"]:
+                pygame.draw.ellipse(self.screen, (127,127,127), crater)
+            player = self.players[state["player"]]
+            self.screen.blit(player, player.get_rect(center=(state["playerX"], state["playerY"])))
+
+        for x, y, size, expType, frames, frame in state["explosions"]:
+            self.screen.blit(self.explosion(expType, frame, size), (x, y))
+
+        # ship, meteors and debris
+        ship = self.rotate(self.ship, state["shipAngle"], state["flipped"])
+        self.screen.blit(ship, ship.get_rect(center=(round(state["shipX"]), round(state["shipY"]))))
+        for x, y, angle in state["meteors"]:
+            meteor = self.rotate(self.meteor, angle)
+            self.screen.blit(meteor, meteor.get_rect(center=(round(x), round(y))))
+        for x, y in state["debris"]:
+            self.screen.fill((25,25,255), (round(x)-1, round(y)-1, 3, 3))
+
+        # score, energy and network
+        score = self.font.render(str(state["score"]), True, (255,255,255))
+        self.screen.blit(score, (1155-score.get_rect().width/2, 120))
+        rect = pygame.Rect(0, 0, self.energy.get_rect().width, state["energy"])
+        rect.bottomleft = 1130, 15+self.energy.get_rect().height
+        pygame.draw.rect(self.screen, (0,255,0), rect)
+        self.screen.blit(self.energy, (1130, 15))
+        self.screen.blit(self.notif.render(self.client.stats(), True, (255,255,0)), (10, 675))
+
+    def mainloop(self):
+        '''MDSpectator.mainloop() -> None
+        starts the main loop'''
+        running = True
+        while running and self.client.connected:
+            for event in pygame.event.get():
+                # close screen
+                if event.type == QUIT or (event.type == KEYUP and (event.key == K_RSHIFT or event.key == K_LSHIFT)):
+                    running = False
+                # move, hover or start on the host
+                if event.type == MOUSEMOTION:
+                    self.client.move(event.pos[0]-(self.width/2-600))
+                if (event.type == KEYDOWN and event.key == K_SPACE) or event.type == MOUSEBUTTONDOWN:
+                    self.client.press()
+
+            # draw between the last two states
+            states = self.client.get_states()
+            if states != None:
+                (old, oldTime), (new, newTime) = states
+                alpha = min(1, (time.perf_counter()-newTime)/max(self.client.tickTime, 0.001))
+                state = self.decode(new)
+                if len(old) == len(new):
+                    state = self.interpolate(self.decode(old), state, alpha)
+                self.draw(state)
+                self.display.blit(self.screen, (self.width/2-600,self.height/2-350))
+                pygame.display.update()
+            pygame.time.wait(5)
+
+        self.client.close()
+        pygame.quit()
+
+class MDWorker:
+    '''runs one job at a time on a worker thread'''
+
+    def __init__(self):
+        '''MDWorker() -> MDWorker
+        constructs the worker and starts its thread'''
+        self.job = None
+        self.error = None
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def start(self, function, *args):
+        '''MDWorker.start(function, *args) -> None
+        starts calling function with args on the worker'''
+        self.wait()
+        with self.condition:
+            self.job = function, args
+            self.condition.notify_all()
+
+    def wait(self):
+        '''MDWorker.wait() -> None
+        waits until the job is done
+        raises the error of the job if it had one'''
+        with self.condition:
+            while self.job != None:
+                self.condition.wait()
+            error, self.error = self.error, None
+        if error != None:
+            raise error
+
+    def run(self):
+        '''MDWorker.run() -> None
+        runs jobs until closed'''
+        while True:
+            with self.condition:
+                while self.job == None and self.running:
+                    self.condition.wait()
+                if self.job == None:
+                    return
+                function, args = self.job
+
+            try:
+                function(*args)
+            except Exception as error:
+                self.error = error
+            finally:
+                with self.condition:
+                    self.job = None
+                    self.condition.notify_all()
+
+    def close(self):
+        '''MDWorker.close() -> None
+        finishes the last job and stops the worker'''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+class MDGovernor:
+    '''lowers the quality of the game when frames take too long
+    and raises it again when there is time to spare'''
+
+    # name, share of debris kept, explosion frame step, frames per present
+    LEVELS = [("full", 1, 1, 1), ("less debris", 0.5, 1, 1), ("coarse explosions", 0.25, 2, 1),
+        ("half present rate", 0.25, 2, 2)]
+
+    def __init__(self, game, enabled=False, fileName="moondefense_quality.log", patience=30, recovery=300):
+        '''MDGovernor(game, enabled=False, fileName="moondefense_quality.log", patience=30, recovery=300) -> MDGovernor
+        constructs the governor. Does nothing unless enabled
+        quality drops after patience slow frames and rises after recovery fast ones'''
+        self.game = game
+        self.enabled = enabled
+        self.fileName = fileName
+        self.patience = patience
+        self.recovery = recovery
+        self.level = 0
+        self.average = 0
+        self.slow = 0
+        self.fast = 0
+        self.frames = 0
+
+    def get_level(self):
+        '''MDGovernor.get_level() -> int
+        returns the quality level, 0 is full quality'''
+        return self.level
+
+    def debris(self, howMany):
+        '''MDGovernor.debris(howMany) -> int
+        returns how many pieces of debris to make instead of howMany'''
+        return max(1, round(howMany*self.LEVELS[self.level][1]))
+
+    def frame_step(self):
+        '''MDGovernor.frame_step() -> int
+        returns how many explosion frames to show as one'''
+        return self.LEVELS[self.level][2]
+
+    def should_present(self):
+        '''MDGovernor.should_present() -> bool
+        returns if this frame should be put on the display'''
+        return self.frames%self.LEVELS[self.level][3] == 0
+
+    def update(self, frameTime):
+        '''MDGovernor.update(frameTime) -> None
+        changes the quality level if needed
+        frameTime is the seconds spent on the frame, not counting waiting'''
+        self.frames += 1
+        if not self.enabled:
+            return
+
+        budget = 1/self.game.fps
+        self.average += (frameTime-self.average)/10
+        self.slow = self.slow+1 if self.average > budget*0.9 else 0
+        self.fast = self.fast+1 if self.average < budget*0.5 else 0
+
+        if self.slow >= self.patience and self.level < len(self.LEVELS)-1:
+            self.change(self.level+1)
+        elif self.fast >= self.recovery and self.level > 0:
+            self.change(self.level-1)
+
+    def change(self, level):
+        '''MDGovernor.change(level) -> None
+        sets the quality level and logs where it changed'''
+        game = self.game
+        entities = len(game.get_meteors())+len(game.enemy.debris)+len(game.explosions)+len(game.get_craters().craters)
+        file = open(self.fileName, "a")
+        file.write(f"tick {game.iterations}: score {game.score}, {entities} entities, {self.average*1000:.1f} ms/frame, " +
+            f"{self.LEVELS[self.level][0]} -> {self.LEVELS[level][0]}\n")
+        file.close()
+
+        self.level = level
+        self.slow = 0
+        self.fast = 0
+
 class MoonDefense:
     '''represents the game objects in one'''
 
-    def __init__(self, dev=False):
-        '''MoonDefense(dev) -> MoonDefense
-        constructs the game objects'''
+    def __init__(self, dev=False, host=False, fps=60, endless=False):
+        '''MoonDefense(dev=False, host=False, fps=60, endless=False) -> MoonDefense
+        constructs the game objects
+        if host, the game is streamed to MDSpectator clients
+        if endless, meteors and ships keep coming faster and quality drops to keep up'''
         pygame.display.set_caption("Moon Defense")
         pygame.display.set_icon(pygame.image.load("logo.png"))
         pygame.mouse.set_visible(False)
         self.display = pygame.display.set_mode((0,0))
         self.screen = pygame.Surface((1200,700))
+        self.front = pygame.Surface((1200,700))
 
         self.width, self.height = pygame.display.get_window_size()
         pygame.draw.rect(self.display, (255,255,255), (self.width/2-600,self.height/2-350,1200,700), 5)
+        self.fps = fps
         self.gameOver = False
+        self.endless = endless
+        self.rampEvery = 600
+        self.profiler = MDProfiler(self, dev)
+        self.governor = MDGovernor(self, endless)
         
         # meteors
         self.meteors = [MDMeteor(self)]
@@ -566,6 +1689,8 @@ class MoonDefense:
         self.explosions = []
         self.explosionCount = 0
         self.finishedExplosions = []
+        self.rewinder = MDRewind(self)
+        self.server = MDServer(self) if host else None
         
         self.dev = dev
         self.font = pygame.font.SysFont(None, 50)
@@ -585,6 +1710,21 @@ class MoonDefense:
         returns the screen of the game'''
         return self.screen
 
+    def get_rewinder(self):
+        '''MoonDefense.get_rewinder() -> MDRewind
+        returns the snapshot keeper for the game'''
+        return self.rewinder
+
+    def get_governor(self):
+        '''MoonDefense.get_governor() -> MDGovernor
+        returns the quality governor for the game'''
+        return self.governor
+
+    def get_profiler(self):
+        '''MoonDefense.get_profiler() -> MDProfiler
+        returns the profiler for the game'''
+        return self.profiler
+
     def get_craters(self):
         '''MoonDefense.get_craters() -> list
         returns a list of all craters'''
@@ -609,7 +1749,7 @@ class MoonDefense:
         '''MoonDefense.explosion(pos, size=100, speed=3, expType=2, frames=3) -> str
         makes an explosion at pos and with size and returns the id of the explosion'''
         self.explosionCount += 1
-        self.explosions.append(MDExplosion(self.screen, pos, size, speed, expType, frames, f"exp{self.explosionCount}"))
+        self.explosions.append(MDExplosion(self, pos, size, speed, expType, frames, f"exp{self.explosionCount}"))
         return f"exp{self.explosionCount}"
 
     def crater(self, pos, size):
@@ -618,6 +1758,18 @@ class MoonDefense:
         self.craters.add_crater((pos[0]-size/2, pos[1]-size/6+random.randint(-5,5), size, size/3))
         self.explosion((pos[0],pos[1]-50), size*1.2, 4, 3, 5)
 
+    def press(self):
+        '''MoonDefense.press() -> None
+        makes the player hover or starts the game'''
+        if self.started and self.energy.is_full():
+            self.energy.empty()
+            self.player.hover()
+        elif not self.started:
+            # restart
+            if self.gameOver:
+                self.restart()
+            self.started = True
+
     def end_game(self):
         '''MoonDefense.end_game() -> None
         ends the game'''
@@ -631,30 +1783,48 @@ class MoonDefense:
 
         # update craters and player and ship
         if self.started:
+            self.profiler.begin("craters")
             self.craters.update()
+            self.profiler.end()
+            self.profiler.begin("player")
             self.player.update_player()
+            self.profiler.end()
 
         # update explosions
+        self.profiler.begin("explosions")
+        self.profiler.begin("explosion list copy")
         explosions = self.explosions[:]
+        self.profiler.end()
         for explosion in explosions:
             if explosion.is_valid():
                 explosion.update()
             else:
                 self.explosions.remove(explosion)
-                self.finishedExplosions.append(explosion.get_id())
+                # only the player waits on an explosion
+                if explosion.get_id() == self.player.expId:
+                    self.finishedExplosions.append(explosion.get_id())
+        self.profiler.end()
 
         # updateand meteors
         if playing:
+            self.profiler.begin("ship")
             self.enemy.update_ship()
+            self.profiler.end()
+            self.profiler.begin("meteors")
             for meteor in self.meteors:
                 meteor.update()
+            self.profiler.end()
                 
         # explosion with meteors
+        self.profiler.begin("collision")
         collision = self.enemy.collision()
+        self.profiler.end()
         if len(collision):
             self.explosion(self.enemy.get_pos(), 150, 4, 4, 5)
             self.enemyDrop = self.iterations
-            self.enemy.add_debris(30)
+            self.enemy.add_debris(self.governor.debris(30+5*self.score*self.endless))
+            if self.endless:
+                self.enemyWait = max(40, self.enemyWait-5)
             self.enemy.hide()
             self.enemy.set_end(False)
             for meteor in collision:
@@ -664,10 +1834,14 @@ class MoonDefense:
 
         # clear craters
         if self.score%10 == 0 and not self.cleared:
-            if self.score < 21:
+            if self.score < 21 or self.endless:
                 self.meteors.append(MDMeteor(self))
             self.craters.clear()
             self.cleared = True
+
+        # endless mode keeps adding meteors
+        if self.endless and playing and not self.gameOver and self.iterations%self.rampEvery == 0:
+            self.meteors.append(MDMeteor(self))
             
         # drop off enemy again
         if self.iterations-self.enemyDrop == self.enemyWait:
@@ -690,9 +1864,18 @@ class MoonDefense:
             high = self.font.render("High: "+str(self.highScore), True, (255,255,255))
             self.screen.blit(high, (10, 10))
 
+        # keep snapshots for rewinding
+        if playing:
+            self.rewinder.record()
+
+        self.profiler.begin("hud")
         score = self.font.render(str(self.score), True, (255,255,255))
         self.screen.blit(score, (1155-score.get_rect().width/2, 120))
         self.energy.update()
+        if self.server != None:
+            self.screen.blit(self.notif.render(self.server.stats(), True, (255,255,0)), (10, 650))
+        self.profiler.draw(self.screen)
+        self.profiler.end()
                          
     def mainloop(self):
         '''MoonDefense.mainloop() -> None
@@ -713,54 +1896,107 @@ class MoonDefense:
         self.screen.blit(high, (10, 10))
         close = self.notif.render("Shift to close", True, 0)
         self.screen.blit(close, (1060, 670))
+        self.front.blit(self.screen, (0,0))
         pygame.display.update()
 
         # main game loop
         running = True
         self.started = False
-        last = time.time()
+        self.last = time.time()
+        worker = MDWorker()
+        deadline = time.perf_counter()
         while running:
-            if self.started:
-                self.speed.append(time.time()-last)
-                last = time.time()
-                self.screen.blit(background, (0,0))
+            frameStart = time.perf_counter()
+            self.profiler.start_frame()
             
-            # event loop for game play
+            # event loop for game play, the game uses the inputs on the worker
+            self.profiler.begin("events")
+            inputs = []
             for event in pygame.event.get():
                 # close screen
                 if event.type == QUIT or (event.type == KEYUP and (event.key == K_RSHIFT or event.key == K_LSHIFT)):
                     running = False
+                # rewind in dev mode
+                if event.type == KEYDOWN and event.key == K_BACKSPACE and self.dev:
+                    inputs.append(("rewind", None))
                 # make player move
-                if event.type == MOUSEMOTION and self.started:
-                    self.player.move(event.pos[0]-(self.width/2-600))
+                if event.type == MOUSEMOTION:
+                    inputs.append(("move", event.pos[0]-(self.width/2-600)))
                 # make player hover or start game
                 if (event.type == KEYDOWN and event.key == K_SPACE) or event.type == MOUSEBUTTONDOWN:
-                    if self.started and self.energy.is_full():
-                        self.energy.empty()
-                        self.player.hover()
-                    elif not self.started:
-                        # restart
-                        if self.gameOver:
-                            self.restart()
-                        self.started = True
-
-            # update game
-            self.update_game(self.started)
-            self.display.blit(self.screen, (self.width/2-600,self.height/2-350))
-            pygame.display.update()
-            pygame.time.wait(10)
-
+                    inputs.append(("press", None))
+            self.profiler.end()
+
+            # make the next frame on the worker while this one is shown
+            # pages are drawn over the shown frame, so they wait for it
+            overlap = self.started
+            worker.start(self.step, inputs, background)
+            if overlap and self.governor.should_present():
+                self.show()
+            worker.wait()
+            self.screen, self.front = self.front, self.screen
+            if not overlap:
+                self.show()
+            self.profiler.end_frame()
+            self.governor.update(time.perf_counter()-frameStart)
+
+            # wait for the next frame, starting over if far behind
+            deadline += 1/self.fps
+            delay = deadline-time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1/self.fps:
+                deadline = time.perf_counter()
+
+        worker.close()
+        if self.server != None:
+            self.server.close()
         if self.dev:
+            self.profiler.report()
             self.graph()
         else:
             pygame.quit()
 
+    def step(self, inputs, background):
+        '''MoonDefense.step(inputs, background) -> None
+        makes the next frame on the back screen, runs on the worker
+        inputs are ("move", x), ("press", None) or ("rewind", None)'''
+        if self.started:
+            self.speed.append(time.time()-self.last)
+            self.last = time.time()
+            self.screen.blit(background, (0,0))
+        # pages stay on screen, so keep drawing over the last frame
+        else:
+            self.screen.blit(self.front, (0,0))
+
+        # inputs from remote clients, they control the same player
+        if self.server != None:
+            inputs += self.server.take_inputs()
+        for kind, x in inputs:
+            if kind == "rewind":
+                self.rewinder.rewind()
+            elif kind == "move" and self.started:
+                self.player.move(x)
+            elif kind == "press":
+                self.press()
+
+        self.update_game(self.started)
+        if self.server != None:
+            self.server.publish()
+
+    def show(self):
+        '''MoonDefense.show() -> None
+        puts the front screen on the display, must run on the main thread'''
+        self.display.blit(self.front, (self.width/2-600,self.height/2-350))
+        pygame.display.update()
+
     def restart(self):
         '''MoonDefense.restart() -> None
         restarts the game'''
         self.gameOver = False
         self.cleared = True
         self.craters.clear()
+        self.finishedExplosions.clear()
         self.score = 0
         
         # reset all objects
@@ -769,6 +2005,8 @@ class MoonDefense:
         self.energy.__init__(self, 5)
         self.meteors = [MDMeteor(self)]
         self.enemyDrop = self.iterations
+        self.enemyWait = 150
+        self.rewinder.snapshots.clear()
         
     def graph(self):
         '''MoonDefense.graph() -> None
@@ -798,5 +2036,9 @@ class MoonDefense:
         file.write(str(score))
         file.close()
         
-pygame.init()
-MoonDefense()
+if __name__ == "__main__":
+    pygame.init()
+    if "--join" in sys.argv:
+        MDSpectator(sys.argv[sys.argv.index("--join")+1])
+    else:
+        MoonDefense(dev="--dev" in sys.argv, host="--host" in sys.argv, endless="--endless" in sys.argv)
@@ -0,0 +1,90 @@
+import time
+from types import SimpleNamespace
+
+import pygame
+import pytest
+
+from moon_defense import MDServer, MDClient
+
+
+def wait_for(check, timeout=5):
+    '''waits until check() is true, fails after timeout seconds'''
+    end = time.time()+timeout
+    while not check():
+        if time.time() > end:
+            pytest.fail("timed out")
+        time.sleep(0.01)
+
+
+def flat(sections):
+    '''returns the state sections as one list, like the client keeps them'''
+    return [value for section in sections for value in section]
+
+
+def make_game():
+    '''returns the parts of a game the server reads'''
+    player = SimpleNamespace(pos=(600, 630), end=False, hovering=False)
+    player.get_pos = lambda: player.pos
+    ship = SimpleNamespace(pos=(600.0, -100.0), angle=0, flipped=False, debris=[])
+    craters = SimpleNamespace(craters=[(100.0, 630.0, 120.0, 40.0)])
+    game = SimpleNamespace(score=0, gameOver=False, started=True, enemy=ship, explosions=[],
+        meteors=[SimpleNamespace(pos=(100.0, 50.0), angle=270)],
+        energy=SimpleNamespace(rect=pygame.Rect(0, 0, 10, 87)))
+    game.get_player = lambda: player
+    game.get_craters = lambda: craters
+    return game
+
+
+@pytest.fixture
+def loopback():
+    game = make_game()
+    server = MDServer(game, "127.0.0.1", 0)
+    client = MDClient("127.0.0.1", server.port)
+    wait_for(lambda: len(server.clients) == 1)
+    yield game, server, client
+    client.close()
+    server.close()
+
+
+def test_keyframe_then_deltas(loopback):
+    game, server, client = loopback
+    server.publish()
+    wait_for(lambda: client.values != None and server.keyframes == 1)
+    assert server.deltas == 0
+    assert client.values == flat(server.state())
+    keyframe = server.bytesSent
+
+    # a meteor moves, only the change is sent
+    game.meteors[0].pos = (120.25, 59.0)
+    server.publish()
+    wait_for(lambda: client.values == flat(server.state()) and server.deltas == 1)
+    assert server.keyframes == 1
+    assert client.values[13:15] == [481, 236]
+    assert server.bytesSent-keyframe < keyframe
+
+    # a new meteor only resends the meteors
+    game.meteors.append(SimpleNamespace(pos=(300.0, 10.0), angle=260))
+    server.publish()
+    wait_for(lambda: client.values == flat(server.state()) and server.deltas == 2)
+    assert server.keyframes == 1
+
+
+def test_inputs(loopback):
+    game, server, client = loopback
+    client.move(300)
+    client.press()
+    inputs = []
+    wait_for(lambda: inputs.extend(server.take_inputs()) or len(inputs) == 2)
+    assert inputs == [("move", 300), ("press", None)]
+
+
+def test_latency(loopback):
+    game, server, client = loopback
+    wait_for(lambda: client.latency > 0)
+    assert client.bytesReceived > 0 and server.bytesReceived > 0
+
+
+def test_port_in_use(loopback):
+    game, server, client = loopback
+    with pytest.raises(OSError):
+        MDServer(game, "127.0.0.1", server.port)